@@ -182,6 +182,7 @@ class App(object):
     ai = None
     ai_models = []
     ai_embedding_function = None # This is the sentence transformer embedding function. It is stored here so it must not be reloaded every time a project is opened. 
+    ai_text_splitter = None  # Token based text splitter for the vectorstore, also stored here so the tokenizer is loaded only once.
     
     def __init__(self):
         self.conn = None
@@ -669,7 +670,7 @@ university, ORCID, GitHub, or Google account.""",
                 'dialogreport_code_summary_splitter0', 'dialogreport_code_summary_splitter0',
                 'stylesheet', 'backup_num', 'codetext_chunksize',
                 'report_text_context_characters', 'report_text_context_style',
-                'ai_enable', 'ai_first_startup', 'ai_model_index'
+                'ai_enable', 'ai_first_startup', 'ai_model_index', 'ai_vectorstore_backend'
                 ]
         for key in keys:
             if key not in settings_data:
@@ -696,6 +697,8 @@ university, ORCID, GitHub, or Google account.""",
                     settings_data[key] = 'True' 
                 if key == 'ai_model_index':
                     settings_data[key] = '0'
+                if key == 'ai_vectorstore_backend':
+                    settings_data[key] = 'chroma'
                     
         # Check AI models
         if len(ai_models) == 0: # no models loaded, create default
@@ -970,7 +973,8 @@ university, ORCID, GitHub, or Google account.""",
             'codetext_chunksize': 50000,
             'ai_enable': 'False',
             'ai_first_startup': 'True',
-            'ai_model_index': -1
+            'ai_model_index': -1,
+            'ai_vectorstore_backend': 'chroma'
         }
 
     def get_file_texts(self, file_ids=None):
@@ -58,6 +58,9 @@ class WorkerSignals(QObject):
     progress
         int indicating % progress
         
+    progress_percent
+        str (name of the item in progress), int (percent finished)
+        
     streaming
         str containing the current streaming response particle coming from the LLM
     """
@@ -66,6 +69,7 @@ class WorkerSignals(QObject):
     error = pyqtSignal(object, object, object)
     result = pyqtSignal(object)
     progress = pyqtSignal(str)
+    progress_percent = pyqtSignal(str, int)
     streaming = pyqtSignal(str)
 
 
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of QualCoder.
+
+QualCoder is free software: you can redistribute it and/or modify it under the
+terms of the GNU Lesser General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later version.
+
+QualCoder is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with QualCoder.
+If not, see <https://www.gnu.org/licenses/>.
+
+Author: Kai Droege (kaixxx)
+https://github.com/ccbogel/QualCoder
+https://qualcoder.wordpress.com/
+
+Classes for the AI vectorstore which depend on heavy libraries (langchain, 
+sentence_transformers, torch). This module is only imported when the 
+vectorstore is opened, so these libraries do not slow down the start of QualCoder.
+"""
+
+from langchain_community.embeddings import SentenceTransformerEmbeddings
+from langchain_text_splitters.character import RecursiveCharacterTextSplitter, _split_text_with_regex
+import numpy as np
+import re
+from typing import Callable, List
+
+
+def auto_device() -> str:
+    """Returns 'cuda' if a CUDA capable GPU is available, 'cpu' otherwise."""
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def auto_dtype(device: str):
+    """Half precision on the GPU, full precision on the CPU (bf16 is not 
+    supported or very slow on many CPUs)."""
+    import torch
+    return torch.float16 if device == 'cuda' else torch.float32
+
+
+class E5SentenceTransformerEmbeddings(SentenceTransformerEmbeddings):
+    
+    def __init__(self, batch_size=64, device=None, dtype=None, set_dtype=True, **kwargs):
+        """Sets up the SentenceTransformer with the given encoding batch size, 
+        device and torch dtype. 
+
+        Args:
+            batch_size (int, optional): number of texts encoded at once. Defaults to 64.
+            device (str, optional): 'cuda' or 'cpu'. Defaults to None (auto-select).
+            dtype (torch.dtype, optional): dtype of the model weights. Defaults to None (auto-select).
+            set_dtype (bool, optional): if False, no dtype is passed on to the model at all 
+                (older versions of sentence-transformers do not accept model_kwargs). Defaults to True.
+            **kwargs: passed on to SentenceTransformerEmbeddings.
+        """
+        if device is None:
+            device = auto_device()
+        model_kwargs = dict(kwargs.pop('model_kwargs', {}))
+        model_kwargs.setdefault('device', device)
+        if set_dtype:
+            model_kwargs.setdefault('model_kwargs', {'torch_dtype': dtype if dtype is not None else auto_dtype(device)})
+        encode_kwargs = dict(kwargs.pop('encode_kwargs', {}))
+        encode_kwargs.setdefault('batch_size', batch_size)
+        encode_kwargs.setdefault('normalize_embeddings', True)
+        encode_kwargs.setdefault('convert_to_numpy', True)
+        super().__init__(model_kwargs=model_kwargs, encode_kwargs=encode_kwargs, **kwargs)
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Compute doc embeddings using a HuggingFace transformer model.
+        This is a special version for E5 embedding models which need 'passage: ' 
+        in front of every chunk of embedded text and 'query: ' in front of 
+        every query.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            List of embeddings, one for each text.
+        """
+        
+        # All prefixed texts are handed to the encoder in one call, so 
+        # SentenceTransformer can process them in batches.
+        emb_texts = ['passage: ' + text for text in texts]
+        return super().embed_documents(emb_texts)
+    
+    def embed_documents_array(self, texts: List[str]) -> np.ndarray:
+        """Same as embed_documents, but returns the embeddings as a float32 numpy 
+        array, without converting every value to a Python float.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            Array of embeddings, one row for each text.
+        """
+        emb_texts = ['passage: ' + text for text in texts]
+        encode_kwargs = dict(self.encode_kwargs)
+        encode_kwargs['convert_to_numpy'] = True
+        return np.asarray(self.client.encode(emb_texts, **encode_kwargs), dtype=np.float32)
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Compute query embeddings using a HuggingFace transformer model.
+        This is a special version for E5 embedding models which need 'passage: ' 
+        in front of every chunk of embedded text and 'query: ' in front of 
+        every query. 
+
+        Args:
+            text: The text to embed.
+
+        Returns:
+            Embeddings for the text.
+        """
+        return super().embed_documents([f'query: {text}'])[0]
+   
+    
+class BatchedLengthTextSplitter(RecursiveCharacterTextSplitter):
+    """A RecursiveCharacterTextSplitter which measures the length of all the splits 
+    on one level with a single call to batched_length_function (e.g. counting 
+    tokens with a fast tokenizer). The lengths are kept while merging the splits, 
+    so no piece of text is measured twice.
+    """
+
+    def __init__(self, batched_length_function: Callable[[List[str]], List[int]], **kwargs):
+        super().__init__(length_function=lambda text: batched_length_function([text])[0], **kwargs)
+        self._batched_length_function = batched_length_function
+
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        """Same as RecursiveCharacterTextSplitter._split_text, but with batched lengths"""
+        final_chunks = []
+        # Get appropriate separator to use
+        separator = separators[-1]
+        new_separators = []
+        for i, _s in enumerate(separators):
+            _separator = _s if self._is_separator_regex else re.escape(_s)
+            if _s == "":
+                separator = _s
+                break
+            if re.search(_separator, text):
+                separator = _s
+                new_separators = separators[i + 1:]
+                break
+
+        _separator = separator if self._is_separator_regex else re.escape(separator)
+        splits = _split_text_with_regex(text, _separator, keep_separator=self._keep_separator)
+        lengths = self._batched_length_function(splits)
+
+        # Now go merging things, recursively splitting longer texts.
+        good_splits = []
+        good_lengths = []
+        _separator = "" if self._keep_separator else separator
+        for s, length in zip(splits, lengths):
+            if length < self._chunk_size:
+                good_splits.append(s)
+                good_lengths.append(length)
+            else:
+                if good_splits:
+                    final_chunks.extend(self._merge_splits_with_lengths(good_splits, good_lengths, _separator))
+                    good_splits = []
+                    good_lengths = []
+                if not new_separators:
+                    final_chunks.append(s)
+                else:
+                    final_chunks.extend(self._split_text(s, new_separators))
+        if good_splits:
+            final_chunks.extend(self._merge_splits_with_lengths(good_splits, good_lengths, _separator))
+        return final_chunks
+
+    def _merge_splits_with_lengths(self, splits: List[str], lengths: List[int], separator: str) -> List[str]:
+        """Same as TextSplitter._merge_splits, but uses the precomputed lengths of the splits"""
+        separator_len = self._length_function(separator) if separator != '' else 0
+        docs = []
+        current_doc = []
+        current_lengths = []
+        total = 0
+        for d, _len in zip(splits, lengths):
+            if total + _len + (separator_len if len(current_doc) > 0 else 0) > self._chunk_size:
+                if len(current_doc) > 0:
+                    doc = self._join_docs(current_doc, separator)
+                    if doc is not None:
+                        docs.append(doc)
+                    # Keep on popping if:
+                    # - we have a larger chunk than in the chunk overlap
+                    # - or if we still have any chunks and the length is long
+                    while total > self._chunk_overlap or (
+                            total + _len + (separator_len if len(current_doc) > 0 else 0) > self._chunk_size
+                            and total > 0):
+                        total -= current_lengths[0] + (separator_len if len(current_doc) > 1 else 0)
+                        current_doc = current_doc[1:]
+                        current_lengths = current_lengths[1:]
+            current_doc.append(d)
+            current_lengths.append(_len)
+            total += _len + (separator_len if len(current_doc) > 1 else 0)
+        doc = self._join_docs(current_doc, separator)
+        if doc is not None:
+            docs.append(doc)
+        return docs
@@ -477,7 +477,7 @@ class AiLLM():
         
         chunks_meta_list = []
         for desc in descriptions:
-            chunks_meta_list.append(self.sources_vectorstore.chroma_db.similarity_search_with_relevance_scores(desc, **search_kwargs))
+            chunks_meta_list.append(self.sources_vectorstore.db.similarity_search_with_relevance_scores(desc, **search_kwargs))
 
         # 3) Consolidate and rank results:
         # Flatten the lists of chunks in chunks_lists and collect all the chunks in a master list.
@@ -19,22 +19,30 @@ https://github.com/ccbogel/QualCoder
 https://qualcoder.wordpress.com/
 """
 
-from chromadb.config import Settings
-from huggingface_hub import hf_hub_url
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from langchain_text_splitters.character import RecursiveCharacterTextSplitter
-from langchain_chroma.vectorstores import Chroma
-from langchain_core.documents.base import Document
-import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    from blake3 import blake3 as content_hash_function  # faster, if installed
+except ModuleNotFoundError:
+    from hashlib import sha256 as content_hash_function
+import inspect
 import os
+from huggingface_hub import hf_hub_url, snapshot_download, try_to_load_from_cache
+from huggingface_hub.constants import HF_HUB_CACHE
+from huggingface_hub.utils import tqdm as hf_tqdm
+import logging
+import numpy as np
 from PyQt6 import QtCore, QtWidgets
+import queue
 import requests
-import time
+import threading
 import traceback
 from typing import List
+import uuid
 
 from qualcoder.ai_async_worker import Worker
 from qualcoder.ai_async_worker import AIException
+from qualcoder.ai_vectorstore_backends import VectorStoreBackend, ChromaBackend, FaissBackend
 from qualcoder.error_dlg import show_error_dlg
 
 # Turn off telemetry
@@ -54,43 +62,64 @@ def ai_exception_handler(exception_type, value, tb_obj):
     show_error_dlg(msg, tb)
 
 
-class E5SentenceTransformerEmbeddings(SentenceTransformerEmbeddings):
-    
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        """Compute doc embeddings using a HuggingFace transformer model.
-        This is a special version for E5 embedding models which need 'passage: ' 
-        in front of every chunk of embedded text and 'query: ' in front of 
-        every query.
+def content_hash(text: str) -> str:
+    """Hash of a chunk of text, used to find identical chunks in the vectorstore"""
+    return content_hash_function(text.encode('utf-8')).hexdigest()
 
-        Args:
-            texts: The list of texts to embed.
 
-        Returns:
-            List of embeddings, one for each text.
-        """
-        
-        emb_texts = []
-        
-        for text in texts:
-            emb_texts.append('passage: ' + text)
-  
-        return super().embed_documents(texts=emb_texts)
+class DownloadCanceled(Exception):
+    """Raised inside the download progress callback to stop the download"""
+    pass
+
+
+def _download_progress_tqdm(vectorstore, signals):
+    """Returns a tqdm class for snapshot_download which reports the progress 
+    via signals.progress_percent and stops the download if 
+    vectorstore.download_model_cancel is set."""
     
-    def embed_query(self, text: str) -> List[float]:
-        """Compute query embeddings using a HuggingFace transformer model.
-        This is a special version for E5 embedding models which need 'passage: ' 
-        in front of every chunk of embedded text and 'query: ' in front of 
-        every query. 
+    byte_bar_created = False
+    
+    class ProgressTqdm(hf_tqdm):
+        def __init__(self, *args, **kwargs):
+            nonlocal byte_bar_created
+            name = kwargs.get('name') or ''
+            # huggingface_hub disables the bars if there is no terminal (as in the GUI), 
+            # a disabled bar does not count anything.
+            kwargs['disable'] = False
+            super().__init__(*args, **kwargs)
+            # snapshot_download creates several bars: bytes received, bytes written to disk 
+            # and files finished (older versions of huggingface_hub only the last one). 
+            # Only the bytes written are reported, or the files if there is no byte bar.
+            if kwargs.get('unit') == 'B':
+                self.reported = not name.endswith('.transfer')
+                byte_bar_created = byte_bar_created or self.reported
+            else:
+                self.reported = not byte_bar_created
+            
+        def update(self, n=1):
+            if vectorstore.download_model_cancel:
+                raise DownloadCanceled()
+            res = super().update(n)
+            if self.reported and self.total and signals is not None and signals.progress_percent is not None:
+                signals.progress_percent.emit(vectorstore.model_name, min(100, round(self.n / self.total * 100)))
+            return res
+        
+    return ProgressTqdm
 
-        Args:
-            text: The text to embed.
 
-        Returns:
-            Embeddings for the text.
-        """
-        return super().embed_documents([f'query: {text}'])[0]
-   
+class _ImportPipeline():
+    """The queues and state of one run of the import pipeline, see 
+    AiVectorstore._start_import_pipeline"""
     
+    def __init__(self, stop):
+        self.encode_queue = queue.Queue(maxsize=4)
+        self.write_queue = queue.Queue(maxsize=4)
+        self.stop = stop  # threading.Event, set by AiVectorstore.close()
+        self.accepting = True  # False once the encode worker has finished
+        self.splitting_done = False  # True once all import workers are done
+        self.pending = defaultdict(int)  # document id -> batches queued but not yet written
+
+
 class AiVectorstore():
     """ This is the memory of the AI. 
     It manages a chromadb vectorstore with embeddings for all text based 
@@ -102,18 +131,24 @@ class AiVectorstore():
 
     app = None
     parent_text_edit = None
-    ready = False  # If the chroma_db is busy indexing documents, ready will be "False" since we cannot make any queries yet.
+    ready = False  # If the vectorstore is busy indexing documents, ready will be "False" since we cannot make any queries yet.
     import_workers_count = 0
+    import_threads_count = min(4, os.cpu_count() or 1)  # number of documents imported in parallel
+    import_batch_size = 64  # number of chunks embedded and added to the vectorstore at once
     # Setup the database 
     model_name = "intfloat/multilingual-e5-large"
-    cache_folder = os.path.join(os.path.expanduser('~'), '.cache', 'torch', 'sentence_transformers')
-    model_folder = os.path.join(cache_folder, model_name.replace("/", "_"))
+    # The model is stored in the shared huggingface hub cache, so it can be reused by other 
+    # tools. HF_HUB_CACHE honors the environment variables HF_HOME and HUGGINGFACE_HUB_CACHE.
+    cache_folder = HF_HUB_CACHE
+    # Older versions of QualCoder (and the fallback downloader) stored the model here:
+    model_folder = os.path.join(os.path.expanduser('~'), '.cache', 'torch', 'sentence_transformers', 
+                                model_name.replace("/", "_"))
     model_files = [
         '1_Pooling/config.json',
         '.gitattributes',
         'config.json',
+        'model.safetensors',  # the model weights
         'modules.json',
-        'pytorch_model.bin',
         'README.md',
         'sentence_bert_config.json',
         'sentencepiece.bpe.model',
@@ -121,10 +156,16 @@ class AiVectorstore():
         'tokenizer.json',
         'tokenizer_config.json'
     ]
+    # Instead of model.safetensors, older versions of QualCoder downloaded the weights in this format:
+    legacy_weights_file = 'pytorch_model.bin'
+    _cached_ready = False  # see embedding_model_is_cached
     download_model_running = False
     download_model_cancel = False
-    download_model_msg = ''
-    chroma_db = None
+    download_block_size = 1 << 20  # 1 MiB, see _copy_download
+    # The splitter is stateless and shared by all imports (and threads), see _open_db.
+    text_splitter_separators = [".", "!", "?", "\n\n", "\n", " ", ""]
+    text_splitter = None
+    db = None  # VectorStoreBackend, see ai_vectorstore_backends.py
     _is_closing = False
     collection_name = ''
     
@@ -133,7 +174,26 @@ class AiVectorstore():
         self.parent_text_edit = parent_text_edit
         self.collection_name = collection_name
         self.threadpool = QtCore.QThreadPool()
-        self.threadpool.setMaxThreadCount(1)
+        # Several documents are split in parallel. The chunks are passed on to the import 
+        # pipeline, which runs in two more threads (see _start_import_pipeline).
+        self.threadpool.setMaxThreadCount(self.import_threads_count + 2)
+        # content_hash -> id of an embedding in the vectorstore with this content, see _embed_batch        
+        self._content_hashes = {}
+        self._pipeline = None  # the pipeline fed by the current import workers
+        self._pipelines = []  # all pipelines which have not finished writing
+        self._document_workers_count = 0  # import workers feeding the current pipeline
+        self._update_deferred = False  # see update_vectorstore
+        # Stops the import pipelines and workers of the current project, see close(). 
+        # Every project gets a new event, so workers which outlive close() still see it.
+        self._stop = threading.Event()
+        # Imports and deletes of the same document are carried out one after the other, 
+        # in the order in which they were requested (see _document_ticket). 
+        # The condition guards the tickets and the pending batches of all pipelines.
+        self._documents_cond = threading.Condition()
+        self._document_tickets = defaultdict(int)  # document id -> next ticket
+        self._document_turns = defaultdict(int)  # document id -> ticket whose turn it is
+        # ids of the documents imported or deleted since the snapshot in update_vectorstore
+        self._changed_documents = set()
         
     def prepare_embedding_model(self, parent_window=None) -> bool:
         """Downloads the embeddings model if needed.    
@@ -162,85 +222,201 @@ want to continue?\
                 pd.setStyleSheet('* {font-size: ' + str(self.app.settings['fontsize']) + 'pt}')
                 pd.setWindowTitle(_('Download AI components'))
                 pd.setAutoClose(False)
-                pd.show()
-                self.download_embedding_model()
-                while self.download_model_running:
-                    if pd.wasCanceled():
-                        self.download_model_cancel = True
-                        self.app.settings['ai_enable'] = 'False'
-                        return False
-                    else:
-                        # update progress bar
-                        msg = self.download_model_msg
-                        msgs = msg.split(':')
-                        if len(msgs) > 1:
-                            pd.setValue(int(''.join(filter(str.isdigit, msgs[1]))))
-                            msg = msgs[0]
-                        else:
-                            pd.setValue(0)                            
-                        pd.setLabelText(_('Downloading ') + msg)
-                        QtWidgets.QApplication.processEvents()  # update the progress dialog
-                        time.sleep(0.01)
-                pd.close()
+                pd.setValue(0)
+                pd.setLabelText(_('Downloading ') + self.model_name)
+
+                def update_progress(name, percent):
+                    pd.setLabelText(_('Downloading ') + name)
+                    pd.setValue(percent)
+                
+                def cancel_download():
+                    self.download_model_cancel = True
+                    
+                def download_finished():
+                    # Closing the dialog emits "canceled", even after a successful download
+                    pd.canceled.disconnect(cancel_download)
+                    pd.close()
+                    
+                pd.canceled.connect(cancel_download)
+                # The signals of the worker are delivered to the GUI thread, 
+                # pd.exec() runs the event loop until the download is finished or canceled.    
+                self.download_embedding_model(progress_callback=update_progress, finished_callback=download_finished)
+                pd.exec()
+                if self.download_model_cancel or not self.embedding_model_is_cached():  # canceled or failed
+                    self.app.settings['ai_enable'] = 'False'
+                    return False
             else:
                 self.app.settings['ai_enable'] = 'False'
                 return False
         return True
         
     def embedding_model_is_cached(self) -> bool:
-        """Checks if the embeddings model from huggingface is already downloaded 
-        and in the local cache."""
-        return os.path.exists(os.path.join(self.model_folder, self.model_files[-1]))
+        """Checks if all the files of the embeddings model from huggingface are 
+        already downloaded and in the local cache. 
+        Once the model is complete, the result is remembered and not checked again."""
+        if not self._cached_ready:
+            self._cached_ready = self._model_folder_is_complete() or \
+                all(isinstance(try_to_load_from_cache(self.model_name, filename=file_name, 
+                                                      cache_dir=self.cache_folder), str)
+                    for file_name in self.model_files)
+        return self._cached_ready
+    
+    def _model_folder_is_complete(self) -> bool:
+        """Checks if all the model files are in self.model_folder (downloaded 
+        by older versions of QualCoder or the fallback downloader)"""
+        for file_name in self.model_files:
+            if not os.path.exists(os.path.join(self.model_folder, file_name)):
+                if file_name != 'model.safetensors' or \
+                        not os.path.exists(os.path.join(self.model_folder, self.legacy_weights_file)):
+                    return False
+        return True
+    
+    def _embedding_model_path(self) -> str:
+        """Returns the local folder of the embedding model: the folder downloaded by older 
+        versions of QualCoder, or the snapshot in the huggingface hub cache. 
+        Loading the model from this folder never starts a download."""
+        if self._model_folder_is_complete():
+            return self.model_folder
+        config_file = try_to_load_from_cache(self.model_name, filename='config.json', cache_dir=self.cache_folder)
+        if not self.embedding_model_is_cached() or not isinstance(config_file, str):
+            raise AIException(_('AI: The embedding model has not been downloaded.'))
+        return os.path.dirname(config_file)
     
     def _download_embedding_model(self, signals=None):
         """Background thread to download the embedding model to the local cache if necessary.
+        Uses snapshot_download from the huggingface hub, which downloads several files 
+        in parallel.
 
         Args:
-            progress_callback (function(msg), optional): called regularly with an update
-                                                         message containing the file which
-                                                         is downloaded and the percent finished. 
+            signals (WorkerSignals, optional): signals.progress is emitted regularly with an 
+                                               update message containing the name of the model
+                                               and the percent finished. 
         """
         if not self.embedding_model_is_cached():
             self.download_model_running = True
             self.download_model_cancel = False
-            for file_name in self.model_files:
-                local_path = os.path.join(self.model_folder, file_name)
-                if os.path.exists(local_path):
-                    continue  # skip this file, already downloaded
-                url = hf_hub_url(self.model_name, file_name)
-                
-                # create local dir if necessary
-                local_folder = os.path.dirname(local_path)  # (may contain subdir to model_folder)
-                os.makedirs(local_folder, exist_ok=True)
-                tmp_filename = local_path + ".tmp"
-                
-                # download
-                r = requests.get(url, stream=True, timeout=20)
+            # older versions of huggingface_hub do not support all arguments 
+            snapshot_args = inspect.signature(snapshot_download).parameters
+            if not all(arg in snapshot_args for arg in ('allow_patterns', 'max_workers', 'tqdm_class')):
+                logger.debug('snapshot_download is outdated, downloading files one by one.')
+                self._download_embedding_model_files(signals)
+                return
+            try:
+                snapshot_download(repo_id=self.model_name,
+                                  cache_dir=self.cache_folder,
+                                  allow_patterns=self.model_files,
+                                  max_workers=8,
+                                  tqdm_class=_download_progress_tqdm(self, signals))
+            except DownloadCanceled:
+                return  # cancel the download
+
+    def _download_embedding_model_files(self, signals=None):
+        """Fallback for _download_embedding_model: downloads the files of the 
+        embedding model into self.model_folder, several files in parallel.
+        signals.progress_percent reports the progress over all files."""
+        if self.embedding_model_is_cached():
+            return
+        downloads = []  # (url, local_path)
+        for file_name in self.model_files:
+            local_path = os.path.join(self.model_folder, file_name)
+            if not os.path.exists(local_path):  # skip files already downloaded
+                downloads.append((hf_hub_url(self.model_name, file_name), local_path))
+        
+        progress_mutex = QtCore.QMutex()
+        progress = {'written': 0, 'total': 0}
+        
+        def progress_callback(n_bytes):
+            progress_mutex.lock()
+            progress['written'] += n_bytes
+            percent = min(100, round(progress['written'] / progress['total'] * 100)) if progress['total'] > 0 else 0
+            progress_mutex.unlock()
+            if signals is not None and signals.progress_percent is not None:
+                signals.progress_percent.emit(self.model_name, percent)
+            print(f'{self.model_name}: {percent}%', '                           ', end='\r', flush=True)
+        
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            # Get the sizes of all files first, so the progress is correct from the beginning
+            progress['total'] = sum(executor.map(self._download_size, [url for url, _ in downloads]))
+            futures = [executor.submit(self._download_one, url, local_path, progress_callback) 
+                       for url, local_path in downloads]
+            for future in as_completed(futures):
+                try:
+                    future.result()  # raises the errors of the download threads
+                except Exception:
+                    # stop the other downloads, so the error is reported right away
+                    self.download_model_cancel = True
+                    raise
+        if self.download_model_cancel:
+            return
+        if signals is not None and signals.progress_percent is not None:
+            signals.progress_percent.emit(self.model_name, 100)
+        print(f'{self.model_name}: 100%', '                           ', end='\r', flush=True)
+    
+    @staticmethod
+    def _download_size(url) -> int:
+        """Returns the size in bytes of the file at url (0 if unknown)"""
+        r = requests.head(url, allow_redirects=True, timeout=20)
+        r.raise_for_status()  # raise error on 404 etc.
+        return int(r.headers.get('content-length', 0))
+    
+    def _download_one(self, url, local_path, progress_callback=None) -> bool:
+        """Downloads a single file of the embedding model, see _download_embedding_model_files.
+
+        Args:
+            url (String): url of the file
+            local_path (String): where to store the file
+            progress_callback (function(n_bytes), optional): called after each block written.
+
+        Returns:
+            bool: False if the download was canceled
+        """
+        if self.download_model_cancel:
+            return False
+        # create local dir if necessary
+        local_folder = os.path.dirname(local_path)  # (may contain subdir to model_folder)
+        os.makedirs(local_folder, exist_ok=True)
+        tmp_filename = local_path + ".tmp"
+        
+        # download
+        completed = False
+        try:
+            with requests.get(url, stream=True, timeout=20) as r:
                 r.raise_for_status()  # raise error on 404 etc.
                 with open(tmp_filename, "wb") as f:
-                    total_length = int(r.headers.get('content-length'))
-                    expected_size = (total_length/1024) + 1
-                    i = 0
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if self.download_model_cancel:
-                            return  # cancel the download
-                        if chunk:
-                            f.write(chunk)
-                            i += 1
-                            msg = f'{os.path.basename(local_path)}: {round(i/expected_size * 100)}%'
-                            if signals is not None and signals.progress is not None:
-                                signals.progress.emit(msg)
-                            print(msg, '                           ', end='\r', flush=True)
-                msg = f'{os.path.basename(local_path)}: 100%'
-                if signals is not None and signals.progress is not None:
-                    signals.progress.emit(msg)
-                print(msg, '                           ', end='\r', flush=True)
-                if os.path.exists(local_path):
-                    os.remove(local_path)
-                os.rename(tmp_filename, local_path) 
-                
-    def _download_embedding_model_callback(self, msg):
-        self.download_model_msg = msg
+                    completed = self._copy_download(r, f, progress_callback)
+        finally:
+            if not completed and os.path.exists(tmp_filename):  # canceled or failed
+                os.remove(tmp_filename)
+        if not completed:
+            return False
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        os.rename(tmp_filename, local_path)
+        return True 
+
+    def _copy_download(self, response, f, progress_callback=None) -> bool:
+        """Writes the body of a streamed requests response to the file f. 
+        Works like shutil.copyfileobj with blocks of download_block_size, but 
+        checks for cancellation and reports the progress once per block.
+
+        Args:
+            response (requests.Response): opened with stream=True
+            f (file): opened in binary mode for writing
+            progress_callback (function(n_bytes), optional): called after each block written.
+
+        Returns:
+            bool: False if the download was canceled
+        """
+        response.raw.decode_content = True
+        while True:
+            if self.download_model_cancel:
+                return False
+            block = response.raw.read(self.download_block_size)
+            if not block:
+                return True
+            f.write(block)
+            if progress_callback is not None:
+                progress_callback(len(block))
     
     def _download_embedding_model_finished(self):
         if not self.ai_worker_running():
@@ -252,40 +428,100 @@ want to continue?\
             self.parent_text_edit.append(msg)
             logger.debug(msg)
 
-    def download_embedding_model(self):
+    def download_embedding_model(self, progress_callback=None, finished_callback=None):
         """Downloads the embedding model to the local cache if necessary.
         self.download_model_running will be True until all files have finished downloading.
+
+        Args:
+            progress_callback (function(name, percent), optional): called in the GUI thread 
+                                                                   with the progress of the download.
+            finished_callback (function(), optional): called in the GUI thread when the download 
+                                                      has finished or was canceled.
         """
         self.download_model_running = True
         worker = Worker(self._download_embedding_model)
         worker.signals.finished.connect(self._download_embedding_model_finished)
-        worker.signals.progress.connect(self._download_embedding_model_callback)
+        if finished_callback is not None:
+            worker.signals.finished.connect(finished_callback)
+        if progress_callback is not None:
+            worker.signals.progress_percent.connect(progress_callback)
         worker.signals.error.connect(ai_exception_handler)
         self.threadpool.start(worker)
     
+    def _create_token_text_splitter(self):
+        """Creates a text splitter (BatchedLengthTextSplitter) which measures the 
+        chunk size in tokens of the embedding model (which can encode 512 tokens at most). 
+        All the splits are tokenized in batches with a separate fast tokenizer.
+        """
+        from transformers import AutoTokenizer
+        from qualcoder.ai_embeddings import BatchedLengthTextSplitter
+        tokenizer = AutoTokenizer.from_pretrained(self._embedding_model_path(), local_files_only=True, 
+                                                  use_fast=True).backend_tokenizer
+        # count all tokens, even if a split is longer than the model can encode
+        tokenizer.no_truncation()
+        tokenizer.no_padding()
+
+        def count_tokens(texts: List[str]) -> List[int]:
+            return [len(encoding.ids) for encoding in tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+        return BatchedLengthTextSplitter(count_tokens, separators=self.text_splitter_separators, 
+                                         keep_separator='end', chunk_size=200, chunk_overlap=20)
+    
+    def _create_db(self, embedding_function=None, only_existing=False) -> VectorStoreBackend:
+        """Opens the vectorstore of the current project with the backend selected in 
+        the settings ('ai_vectorstore_backend': 'chroma' (default) or 'faiss').
+        Returns None if only_existing is True and there is no vectorstore yet."""
+        ai_data_path = os.path.join(self.app.project_path, 'ai_data')
+        if self.app.settings.get('ai_vectorstore_backend', 'chroma') == 'faiss':
+            db_path = os.path.join(ai_data_path, 'faiss')
+            if only_existing and not os.path.exists(db_path):
+                return None
+            try:
+                return FaissBackend(db_path, self.collection_name, embedding_function)
+            except ModuleNotFoundError:
+                logger.warning('faiss is not installed, using chroma as vectorstore backend.')
+        db_path = os.path.join(ai_data_path, 'vectorstore')
+        if only_existing and not os.path.exists(db_path):
+            return None
+        return ChromaBackend(db_path, self.collection_name, embedding_function)
+    
     def _open_db(self, signals):
         # "signals" is when this is called by the Worker in ai_async_worker. Cannot omit it.
         if self._is_closing:
             return  # abort when closing db
         if self.app.project_path != '' and os.path.exists(self.app.project_path):
-            db_path = os.path.join(self.app.project_path, 'ai_data', 'vectorstore')
+            # These imports take several seconds, they are only loaded if the AI is used
+            from langchain_text_splitters.character import RecursiveCharacterTextSplitter
+            from qualcoder.ai_embeddings import E5SentenceTransformerEmbeddings, auto_device, auto_dtype
+            
             if self.app.ai_embedding_function is None:
-                self.app.ai_embedding_function = E5SentenceTransformerEmbeddings(model_name=self.model_folder)
-            # {"hnsw:space": "cosine"} -> defines the distance function, cosine vs. Squared L2 (default).
-            # In my limited tests, l2 gives slightly better results, although cosine is usually recommended
-            collection_metadata = {"hnsw:space": "l2"}
-            chroma_client_settings = Settings(
-                                        is_persistent=True,
-                                        persist_directory=db_path,
-                                        anonymized_telemetry=False
-                                     )
-            self.chroma_db = Chroma(client_settings=chroma_client_settings, 
-                                    embedding_function=self.app.ai_embedding_function,
-                                    collection_name=self.collection_name,
-                                    collection_metadata=collection_metadata
-                             )
+                model_path = self._embedding_model_path()  # (local folder, no download)
+                device = auto_device()
+                try:
+                    self.app.ai_embedding_function = E5SentenceTransformerEmbeddings(
+                        model_name=model_path,
+                        batch_size=self.import_batch_size,
+                        device=device, dtype=auto_dtype(device))
+                except (RuntimeError, TypeError, ValueError) as err:
+                    # reduced precision not supported on this device (or model_kwargs not supported 
+                    # by an older sentence-transformers), fall back to the default dtype (float32)
+                    logger.debug(f'Loading embedding model failed ({err}), falling back to float32.')
+                    self.app.ai_embedding_function = E5SentenceTransformerEmbeddings(
+                        model_name=model_path,
+                        batch_size=self.import_batch_size,
+                        device=device, set_dtype=False)
+            if self.app.ai_text_splitter is None:
+                try:
+                    self.app.ai_text_splitter = self._create_token_text_splitter()
+                except (OSError, ValueError) as err:
+                    logger.debug(f'Loading the tokenizer failed ({err}), using character based text splitting.')
+                    self.app.ai_text_splitter = RecursiveCharacterTextSplitter(
+                        separators=self.text_splitter_separators, keep_separator='end', 
+                        chunk_size=500, chunk_overlap=100)
+            self.text_splitter = self.app.ai_text_splitter
+            self.db = self._create_db(self.app.ai_embedding_function)
         else:
-            self.chroma_db = None
+            self.db = None
             logger.debug(f'Project path "{self.app.project_path}" not found.')
             raise FileNotFoundError(f'AI Vectorstore: project path "{self.app.project_path}" not found.')
         self.app.ai._status = ''
@@ -299,7 +535,11 @@ want to continue?\
             rebuild (bool, optional): Rebuild the vectorstore from the ground up. Defaults to False.
         """
         self._is_closing = False        
-        self.prepare_embedding_model()
+        if not self.prepare_embedding_model():
+            # download declined, canceled or failed
+            self.parent_text_edit.append(_('AI: The embedding model is not available, AI is disabled.'))
+            self.app.ai._status = ''
+            return
         
         if self.app.project_name == '':  # no project open
             self.close()
@@ -320,6 +560,15 @@ want to continue?\
     def progress_import(self, msg):
         self.parent_text_edit.append(msg)
         
+    def _finished_document_import(self):
+        self._document_workers_count -= 1
+        if self._document_workers_count <= 0 and self._pipeline is not None:
+            # All documents are split, let the import pipeline finish its work 
+            self._document_workers_count = 0
+            self._pipeline.splitting_done = True
+            self._pipeline = None
+        self.finished_import()
+    
     def finished_import(self):
         self.import_workers_count -= 1
         if self.import_workers_count <= 0:
@@ -327,24 +576,338 @@ want to continue?\
             msg = _("AI: Checked all documents, memory is up to date.")
             self.parent_text_edit.append(msg)
             logger.debug(msg)
+            if self._update_deferred:
+                self._update_deferred = False
+                self.update_vectorstore()
     
-    def _import_document(self, id_, name, text, update=False, signals=None):
-        if self._is_closing:
-            return  # abort when closing db
-        if self.chroma_db is None:
-            raise AIException(_('Vectorstore: Document import failed, chroma_db not present.'))
+    def _split_text(self, text):
+        """Splits the text into chunks with self.text_splitter.
+
+        Returns:
+            (List[String], List[int]): the chunks and the position of each chunk in the text
+        """
+        splitter = self.text_splitter
+        chunks = splitter.split_text(text)
+        # The chunks are in order. Each chunk starts after the start of the previous one 
+        # and overlaps with it by chunk_overlap at most. (add_start_index in langchain 
+        # assumes that the overlap is measured in characters, which is wrong for tokens.)
+        start_indices = []
+        start = -1
+        end = 0
+        for chunk in chunks:
+            first = text.find(chunk, start + 1)
+            found = first
+            while 0 <= found < end and splitter._length_function(text[found:end]) > splitter._chunk_overlap:
+                found = text.find(chunk, found + 1)
+            if found < 0:
+                found = first if first >= 0 else text.find(chunk)
+            if found >= 0:
+                start = found
+                end = found + len(chunk)
+            start_indices.append(found)
+        return chunks, start_indices
+    
+    def _merge_small_chunks(self, text, chunks, start_indices):
+        """Second pass after splitting the text: merges adjacent chunks if the result still 
+        fits into the chunk size and they are not separated by a paragraph break. 
+        Chunks smaller than a fifth of the chunk size carry little context, they are merged 
+        into their neighbor even across a paragraph break (and may exceed the chunk size slightly). 
+        Fewer chunks means fewer embeddings to compute and to store.
+
+        Args:
+            text (String): the text which has been split
+            chunks (List[String]): the chunks
+            start_indices (List[int]): the position of each chunk in the text
+
+        Returns:
+            (List[String], List[int]): the merged chunks and their positions in the text 
+                                       (= the position of the first of the merged chunks)
+        """
+        if len(chunks) < 2:
+            return chunks, start_indices
+        splitter = self.text_splitter
+        length_function = splitter._length_function
+        batched_length_function = getattr(splitter, '_batched_length_function', None)
+        if batched_length_function is not None:
+            lengths = batched_length_function(chunks)
+        else:
+            lengths = [length_function(chunk) for chunk in chunks]
+        chunk_size = splitter._chunk_size
+        min_chunk_size = chunk_size // 5
+        
+        merged = [chunks[0]]
+        merged_starts = [start_indices[0]]
+        merged_lengths = [lengths[0]]
+        for chunk, chunk_start, length in zip(chunks[1:], start_indices[1:], lengths[1:]):
+            start = merged_starts[-1]
+            prev_end = start + len(merged[-1])
+            small = merged_lengths[-1] < min_chunk_size or length < min_chunk_size
+            # Only compute the exact length of the merged text if merging is possible at all 
+            # (overlapping chunks are shorter together than the sum of their lengths).
+            if start < 0 or chunk_start < start or \
+                    (not small and merged_lengths[-1] + length > chunk_size + splitter._chunk_overlap):
+                merged.append(chunk)
+                merged_starts.append(chunk_start)
+                merged_lengths.append(length)
+                continue
+            paragraph_break = chunk_start >= prev_end and '\n\n' in text[prev_end:chunk_start]
+            combined = text[start:chunk_start + len(chunk)]
+            combined_length = length_function(combined)
+            if (combined_length <= chunk_size and not paragraph_break) or \
+                    (small and combined_length <= chunk_size + min_chunk_size):
+                merged[-1] = combined
+                merged_lengths[-1] = combined_length
+            else:
+                merged.append(chunk)
+                merged_starts.append(chunk_start)
+                merged_lengths.append(length)
+        return merged, merged_starts
+    
+    def _start_import_pipeline(self) -> _ImportPipeline:
+        """Starts the import pipeline if it is not running yet and returns it. 
+        The import workers put batches of chunks into its encode_queue. 
+        _encode_worker creates the embeddings and passes them on to _write_worker, 
+        which stores them in the vectorstore. So encoding the next batch overlaps 
+        with writing the last one. The write queue is limited, so the embeddings 
+        waiting to be written do not fill up the memory. The encode queue is limited as well, 
+        so splitting the documents does not run far ahead of encoding.
+        The pipeline finishes when all import workers are done, see _finished_document_import. 
+        """
+        if self._pipeline is not None:
+            return self._pipeline
+        pipeline = _ImportPipeline(self._stop)
+        with self._documents_cond:
+            self._pipelines.append(pipeline)
+        self._pipeline = pipeline
+        encode_worker = Worker(self._encode_worker, pipeline)
+        encode_worker.signals.error.connect(ai_exception_handler)
+        write_worker = Worker(self._write_worker, pipeline)
+        write_worker.signals.finished.connect(self.optimize_db)
+        write_worker.signals.finished.connect(self.finished_import)
+        write_worker.signals.error.connect(ai_exception_handler)
+        self.import_workers_count += 1  # the pipeline counts as one worker
+        self.threadpool.start(encode_worker)
+        self.threadpool.start(write_worker)
+        return pipeline
+    
+    def optimize_db(self):
+        """Lets the backend reorganize the vectorstore in a background thread if necessary 
+        (see FaissBackend.optimize). The vectorstore can still be used in the meantime."""
+        if self.db is not None and self.db.needs_optimize():
+            worker = Worker(self._optimize_db, self.db)
+            worker.signals.error.connect(ai_exception_handler)
+            self.threadpool.start(worker)
+    
+    def _optimize_db(self, db, signals=None):
+        db.optimize()
+    
+    def _document_ticket(self, id_) -> int:
+        """Reserves the next turn to import or delete the document id_ (called in the GUI 
+        thread, so the turns follow the order of the calls), see _wait_for_document."""
+        with self._documents_cond:
+            ticket = self._document_tickets[id_]
+            self._document_tickets[id_] += 1
+        return ticket
+    
+    def _wait_for_document(self, id_, ticket, stop) -> bool:
+        """Waits until it is the turn of ticket and all batches of earlier imports of the 
+        document id_ are written. Returns False if stop was set while waiting.
+        _document_done must be called afterwards in any case."""
+        with self._documents_cond:
+            while self._document_turns[id_] != ticket or \
+                    any(pipeline.pending.get(id_, 0) > 0 for pipeline in self._pipelines):
+                if stop.is_set():
+                    return False
+                self._documents_cond.wait(0.1)
+        return not stop.is_set()
+    
+    def _document_done(self, id_, stop):
+        """Passes the turn for the document id_ on to the next ticket."""
+        with self._documents_cond:
+            if not stop.is_set():  # (after close(), the turns have been reset)
+                self._document_turns[id_] += 1
+                self._changed_documents.add(id_)
+            self._documents_cond.notify_all()
+    
+    def _queue_batch(self, pipeline, texts, metadatas, known_embeddings=None) -> bool:
+        """Passes a batch of chunks of one document on to the encode worker of pipeline. 
+        known_embeddings (content_hash -> embedding) may contain the embeddings of chunks 
+        which have already been computed, see _embed_batch.
+        Waits while the encode queue is full. Returns False if the pipeline has been stopped."""
+        with self._documents_cond:
+            if pipeline.stop.is_set() or not pipeline.accepting:
+                return False
+            pipeline.pending[metadatas[0]['id']] += 1
+        # (waiting outside the lock, the workers need it to finish their batches)
+        while not pipeline.stop.is_set() and pipeline.accepting:
+            try:
+                pipeline.encode_queue.put((texts, metadatas, known_embeddings), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False  # the batch stays pending, the document is removed by _write_worker
+    
+    def _batch_done(self, pipeline, metadatas):
+        """A batch has been written, see _wait_for_document"""
+        with self._documents_cond:
+            pipeline.pending[metadatas[0]['id']] -= 1
+            self._documents_cond.notify_all()
+    
+    def _queue_put(self, q, item, stop) -> bool:
+        """Puts item into the queue q, waits while the queue is full.
+        Returns False if stop is set."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def _queue_get(self, q, stop):
+        """Gets the next item from the queue q, waits while the queue is empty.
+        Returns None if stop is set."""
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+    
+    def _encode_worker(self, pipeline, signals=None):
+        """Import pipeline: creates the embeddings for the batches of chunks in encode_queue."""
+        try:
+            while True:
+                try:
+                    item = pipeline.encode_queue.get(timeout=0.1)
+                except queue.Empty:
+                    if pipeline.stop.is_set() or pipeline.splitting_done:
+                        return
+                    continue
+                if pipeline.stop.is_set() or self.db is None:
+                    return
+                texts, metadatas, known_embeddings = item
+                embeddings = self._embed_batch(texts, metadatas, known_embeddings)
+                if not self._queue_put(pipeline.write_queue, (texts, metadatas, embeddings), pipeline.stop):
+                    return
+        finally:
+            with self._documents_cond:
+                # Batches queued from now on are rejected. Those still in the encode queue 
+                # (after an error or when closing) stay pending, see _write_worker.
+                pipeline.accepting = False
+            self._queue_put(pipeline.write_queue, None, pipeline.stop)  # let the write worker finish
+    
+    def _write_worker(self, pipeline, signals=None):
+        """Import pipeline: stores the embeddings from write_queue in the vectorstore.
+        Batches which are not written (when closing or after an error) stay pending. 
+        The documents they belong to are only partly stored and are removed again at the end, 
+        so they will be imported completely by the next update_vectorstore."""
+        done = False
+        try:
+            while not done:
+                item = self._queue_get(pipeline.write_queue, pipeline.stop)
+                if item is None:  # finished or closing
+                    done = True
+                elif not pipeline.stop.is_set() and self.db is not None:
+                    self._write_batch(*item)
+                    self._batch_done(pipeline, item[1])
+        finally:
+            # After an error: discard the remaining batches, so the encode worker is not blocked
+            while not done:
+                if self._queue_get(pipeline.write_queue, pipeline.stop) is None:
+                    done = True
+            db = self.db
+            try:
+                if db is not None:
+                    with self._documents_cond:
+                        incomplete = [id_ for id_, count in pipeline.pending.items() if count > 0]
+                    for id_ in incomplete:
+                        ids = db.get(where={"id": id_}, include=['metadatas'])['ids']
+                        if len(ids) > 0:
+                            db.delete(ids)
+                    if not pipeline.stop.is_set():
+                        db.persist()
+            finally:
+                with self._documents_cond:
+                    if pipeline in self._pipelines:
+                        self._pipelines.remove(pipeline)
+                    self._documents_cond.notify_all()
+    
+    def _embed_batch(self, texts, metadatas, known_embeddings=None) -> np.ndarray:
+        """Creates the embeddings for a batch of chunks (in _encode_worker).
+        The embeddings are computed here in one batch and later passed directly to the 
+        collection, so Chroma does not call the embedding function itself.
+        Identical chunks (e.g. repeated headers or interview questions) are embedded 
+        only once: The embeddings of chunks with a known content_hash are copied from 
+        the vectorstore (or taken from known_embeddings, e.g. the old version of an updated 
+        document). All chunks are still stored, so they can be found in every document."""
+        hashes = [metadata['content_hash'] for metadata in metadatas]
+        known_embeddings = dict(known_embeddings or {})  # content_hash -> embedding
+        stored_ids = {self._content_hashes[h]: h for h in set(hashes) 
+                      if h not in known_embeddings and h in self._content_hashes}
+        if len(stored_ids) > 0:
+            stored = self.db.get_embeddings(list(stored_ids))
+            for metadata, embedding in zip(stored['metadatas'], stored['embeddings']):
+                known_embeddings[metadata['content_hash']] = embedding
+            # embeddings deleted in the meantime are not returned, forget them:
+            for emb_id in set(stored_ids).difference(stored['ids']):
+                if self._content_hashes.get(stored_ids[emb_id]) == emb_id:
+                    del self._content_hashes[stored_ids[emb_id]]
+        new_texts = {}  # content_hash -> text, embedded once per batch
+        for text, h in zip(texts, hashes):
+            if h not in known_embeddings and h not in new_texts:
+                new_texts[h] = text
+        if len(new_texts) > 0:
+            new_embeddings = self.app.ai_embedding_function.embed_documents_array(list(new_texts.values()))
+            known_embeddings.update(zip(new_texts.keys(), new_embeddings))
+        return np.asarray([known_embeddings[h] for h in hashes], dtype=np.float32)
+    
+    def _write_batch(self, texts, metadatas, embeddings):
+        """Adds a batch of chunks with their embeddings to the vectorstore (in _write_worker)."""
+        hashes = [metadata['content_hash'] for metadata in metadatas]
+        ids = [str(uuid.uuid4()) for _ in texts]
+        self.db.add(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+        for emb_id, h in zip(ids, hashes):
+            self._content_hashes[h] = emb_id  # the newest embedding with this content
+    
+    def _import_document(self, pipeline, ticket, id_, name, text, update=False, 
+                         existing_ids=None, existing_name=None, signals=None):
+        """Splits a document and passes the chunks on to the import pipeline, 
+        once it is the turn of ticket (see _document_ticket)."""
+        try:
+            if self._wait_for_document(id_, ticket, pipeline.stop):  # (False when closing db)
+                self._import_document_text(pipeline, id_, name, text, update, existing_ids, existing_name, signals)
+        finally:
+            self._document_done(id_, pipeline.stop)
+    
+    def _import_document_text(self, pipeline, id_, name, text, update, existing_ids, existing_name, signals):
+        if self.db is None:
+            raise AIException(_('Vectorstore: Document import failed, vectorstore db not present.'))
                        
-        # Check if the document is already in the store:
-        embeddings_list = self.chroma_db.get(where={"id": id_}, include=['metadatas'])
-        if len(embeddings_list['ids']) > 0:  # Found document in Vectorstore
-            if update or embeddings_list['metadatas'][0]['name'] != name:
-                # delete old embeddings
-                self.chroma_db.delete(embeddings_list['ids']) 
+        # Check if the document is already in the store 
+        # (existing_ids and existing_name may be already known from a bulk query in update_vectorstore, 
+        # unless another import or delete of this document has run since then):
+        with self._documents_cond:
+            if id_ in self._changed_documents:
+                existing_ids = None
+        if existing_ids is None:
+            embeddings_list = self.db.get(where={"id": id_}, include=['metadatas'])
+            existing_ids = embeddings_list['ids']
+            if len(existing_ids) > 0:
+                existing_name = embeddings_list['metadatas'][0]['name']
+        old_embeddings = {}  # content_hash -> embedding of the old version of the document
+        if len(existing_ids) > 0:  # Found document in Vectorstore
+            if update or existing_name != name:
+                # delete old embeddings (but keep them for the unchanged chunks, see _embed_batch)
+                stored = self.db.get_embeddings(existing_ids)
+                for metadata, embedding in zip(stored['metadatas'], stored['embeddings']):
+                    old_embeddings[metadata.get('content_hash')] = embedding
+                self.db.delete(existing_ids) 
             else:
                 # skip the doc
                 return 
-        # add to chroma_db
-        if self._is_closing:
+        # add to the vectorstore
+        if pipeline.stop.is_set():
             return  # abort when closing db
         
         # split fulltext in smaller chunks 
@@ -352,26 +915,35 @@ want to continue?\
             if signals is not None and signals.progress is not None:
                 signals.progress.emit(_('AI: Adding document to internal memory: ') + f'"{name}"')
 
-            metadata = {'id': id_, 'name': name}
-            document = Document(page_content=text, metadata=metadata)
-            text_splitter = RecursiveCharacterTextSplitter(separators=[".", "!", "?", "\n\n", "\n", " ", ""], 
-                                                        keep_separator='end', chunk_size=500, chunk_overlap=100, 
-                                                        add_start_index=True)
-            chunks = text_splitter.split_documents([document])
+            texts, start_indices = self._merge_small_chunks(text, *self._split_text(text))
+            metadatas = [{'id': id_, 'name': name, 'start_index': start_index, 'content_hash': content_hash(chunk)}
+                         for chunk, start_index in zip(texts, start_indices)]
             
-            # create embeddings for these chunks and store them in the chroma_db (with metadata)
-            for chunk in chunks:
-                if not self._is_closing:
-                    self.chroma_db.add_texts([chunk.page_content], [chunk.metadata])  
-                else:  # Canceled, delete the unfinished document from the vectorstore:
-                    embeddings_list = self.chroma_db.get(where={"id": id_}, include=['metadatas'])
-                    self.chroma_db.delete(embeddings_list['ids'])
+            # Pass the chunks on to the import pipeline, which creates the embeddings 
+            # and stores them in the vectorstore (with metadata).
+            # Chunks are added in batches, so the embedding model can encode several at once.
+            for i in range(0, len(texts), self.import_batch_size):
+                batch_metadatas = metadatas[i:i + self.import_batch_size]
+                known_embeddings = {metadata['content_hash']: old_embeddings[metadata['content_hash']] 
+                                    for metadata in batch_metadatas if metadata['content_hash'] in old_embeddings}
+                if not self._queue_batch(pipeline, texts[i:i + self.import_batch_size], 
+                                         batch_metadatas, known_embeddings):
+                    # Canceled, delete the unfinished document from the vectorstore:
+                    embeddings_list = self.db.get(where={"id": id_}, include=['metadatas'])
+                    self.db.delete(embeddings_list['ids'])
                     break
 
-    def import_document(self, id_, name, text, update=False):
-        """Imports a document into the chroma_db. 
+    def _import_documents(self, pipeline, tickets, docs, existing_ids, existing_names, signals=None):
+        """Imports a group of documents in one worker thread, see update_vectorstore"""
+        for doc in docs:
+            self._import_document(pipeline, tickets[doc['id']], doc['id'], doc['name'], doc['fulltext'], False,
+                                  existing_ids.get(doc['id'], []), existing_names.get(doc['id']),
+                                  signals=signals)
+
+    def import_document(self, id_, name, text, update=False, existing_ids=None, existing_name=None):
+        """Imports a document into the vectorstore. 
         If a document with the same id is already in 
-        the chroma_db, it can be updated (update=True) 
+        the vectorstore, it can be updated (update=True) 
         or skipped (update=False).
         This is an async process running in a background
         thread. AiVectorstore.is_ready() will return False
@@ -382,38 +954,59 @@ want to continue?\
             name (String): document name
             text (String): document text
             update (bool, optional): defaults to False.
+            existing_ids (list, optional): ids of the embeddings of this document already
+                in the vectorstore. Defaults to None (will be looked up).
+            existing_name (String, optional): document name stored with existing_ids.
         """   
         
-        worker = Worker(self._import_document, id_, name, text, update)  # Any other args, kwargs are passed to the run function
+        pipeline = self._start_import_pipeline()
+        worker = Worker(self._import_document, pipeline, self._document_ticket(id_), id_, name, text, update,
+                        existing_ids, existing_name)  # Any other args, kwargs are passed to the run function
         # worker.signals.result.connect()
-        worker.signals.finished.connect(self.finished_import)
+        worker.signals.finished.connect(self._finished_document_import)
         worker.signals.progress.connect(self.progress_import)
         worker.signals.error.connect(ai_exception_handler)
         self.import_workers_count += 1
+        self._document_workers_count += 1
         self.threadpool.start(worker)
 
     def update_vectorstore(self):
-        """Collects all text sources from the database and adds them to the chroma_db if 
+        """Collects all text sources from the database and adds them to the vectorstore if 
         not already in there.  
+        If an import is still running, the update starts after it has finished: 
+        Documents whose chunks are not written yet would look like new ones.
         """
         self.app.ai._status = ''
-        if self.chroma_db is None:
-            logger.debug('chroma_db is None')
+        if self.db is None:
+            logger.debug('db is None')
+            return
+        if self.ai_worker_running():
+            self._update_deferred = True
             return
         docs = self.app.get_file_texts()
         
-        # Check if any docs in the vectorstore have been deleted or renamed in the project
-        def search_name(docs, name):
-            for document in docs:
-                if document['name'] == name:
-                    return True
-            return False
-        emb = self.chroma_db.get(include=['metadatas'])
-        for i in range(len(emb['ids'])):
-            emb_id = emb['ids'][i]
-            file_name = emb['metadatas'][i]['name']
-            if not search_name(docs, file_name):
-                self.chroma_db.delete([emb_id])
+        # Check if any docs in the vectorstore have been deleted or renamed in the project.
+        # Collect all embeddings with a single query. Embeddings of deleted or renamed 
+        # docs are removed (with a single delete), the others are passed on to _import_document.
+        names_in_project = {doc['name'] for doc in docs}
+        with self._documents_cond:
+            self._changed_documents.clear()
+        emb = self.db.get(include=['metadatas'])
+        existing_ids = defaultdict(list)
+        existing_names = {}
+        stale_ids = []
+        self._content_hashes = {}
+        for emb_id, metadata in zip(emb['ids'], emb['metadatas']):
+            if metadata['name'] not in names_in_project:
+                stale_ids.append(emb_id)
+            else:
+                existing_ids[metadata['id']].append(emb_id)
+                existing_names[metadata['id']] = metadata['name']
+                if 'content_hash' in metadata:  # (missing in vectorstores from older versions)
+                    self._content_hashes.setdefault(metadata['content_hash'], emb_id)
+        if len(stale_ids) > 0:
+            self.db.delete(stale_ids)
+            self.db.persist()
 
         # Add new docs
         if len(docs) == 0:
@@ -424,52 +1017,99 @@ want to continue?\
             msg = _("AI: Checking for new documents")
             self.parent_text_edit.append(msg)
             logger.debug(msg)
-            for doc in docs:
-                self.import_document(doc['id'], doc['name'], doc['fulltext'], False)
+            # Split the docs into one group per thread and import the groups in parallel
+            pipeline = self._start_import_pipeline()
+            tickets = {doc['id']: self._document_ticket(doc['id']) for doc in docs}
+            groups_count = min(self.import_threads_count, len(docs))
+            for i in range(groups_count):
+                worker = Worker(self._import_documents, pipeline, tickets, docs[i::groups_count], 
+                                existing_ids, existing_names)
+                worker.signals.finished.connect(self._finished_document_import)
+                worker.signals.progress.connect(self.progress_import)
+                worker.signals.error.connect(ai_exception_handler)
+                self.import_workers_count += 1
+                self._document_workers_count += 1
+                self.threadpool.start(worker)
             
     def rebuild_vectorstore(self):
-        """Deletes all contents from chroma_db and rebuilds the vectorstore from the ground up.  
+        """Deletes all contents from the vectorstore and rebuilds the vectorstore from the ground up.  
         """
         self.app.ai._status = ''
-        if self.chroma_db is None:
-            logger.debug('chroma_db is None')
+        if self.db is None:
+            logger.debug('db is None')
             return
         msg = _('AI: Rebuilding memory. The local AI will read through all your documents, please be patient.')
         self.parent_text_edit.append(msg)
         logger.debug(msg)
         # delete all the contents from the vectorstore
-        ids = self.chroma_db.get(include=[])['ids']
+        ids = self.db.get(include=[])['ids']
         if len(ids) > 0:
-            self.chroma_db.delete(ids)
+            self.db.delete(ids)
+            self.db.persist()
         # rebuild vectorstore
         self.update_vectorstore()
     
     def delete_document(self, id_):
         """Deletes all the embeddings from related to this doc 
-        from the vectorstore"""
+        from the vectorstore. 
+        If the vectorstore is open, this runs in a background thread after 
+        all imports of the document which were started before have been written."""
 
-        chroma_db = self.chroma_db
-        if chroma_db is None:
+        if self.db is not None:
+            worker = Worker(self._delete_document, self._stop, self._document_ticket(id_), id_)
+            worker.signals.progress.connect(self.progress_import)
+            worker.signals.error.connect(ai_exception_handler)
+            self.threadpool.start(worker)
+        elif self.app.project_path != '' and os.path.exists(self.app.project_path):
             # Try to create a temporary access
-            if self.app.project_path != '' and os.path.exists(self.app.project_path):
-                db_path = os.path.join(self.app.project_path, 'ai_data', 'vectorstore')
-                if os.path.exists(db_path):
-                    chroma_db = Chroma(persist_directory=db_path,
-                                       collection_name=self.collection_name)
-        if chroma_db is not None:
-            embeddings_list = chroma_db.get(where={"id": id_}, include=['metadatas'])
-            if len(embeddings_list['ids']) > 0:  # Found it
-                self.parent_text_edit.append("AI: Forgetting " + f'"{embeddings_list["metadatas"][0]["name"]}"')
-                chroma_db.delete(embeddings_list['ids']) 
+            db = self._create_db(only_existing=True)
+            if db is not None:
+                msg = self._forget_document(db, id_)
+                db.close()
+                if msg is not None:
+                    self.parent_text_edit.append(msg)
+    
+    def _delete_document(self, stop, ticket, id_, signals=None):
+        """Background thread for delete_document"""
+        try:
+            if self._wait_for_document(id_, ticket, stop) and self.db is not None:
+                msg = self._forget_document(self.db, id_)
+                if msg is not None and signals is not None and signals.progress is not None:
+                    signals.progress.emit(msg)
+        finally:
+            self._document_done(id_, stop)
+    
+    def _forget_document(self, db, id_):
+        """Deletes the embeddings of the document id_ from db. 
+        Returns a message with the document name, or None if the document was not found."""
+        embeddings_list = db.get(where={"id": id_}, include=['metadatas'])
+        if len(embeddings_list['ids']) == 0:
+            return None
+        db.delete(embeddings_list['ids']) 
+        db.persist()
+        return "AI: Forgetting " + f'"{embeddings_list["metadatas"][0]["name"]}"'
                
     def close(self):
         """Cancels the update process if running"""
         self._is_closing = True
         self.download_model_cancel = True
+        self._stop.set()  # stops the import pipelines and workers
         # cancel all waiting threads:
         self.threadpool.clear()
         self.threadpool.waitForDone(5000)
-        self.chroma_db = None
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+        self._content_hashes = {}
+        self._pipeline = None
+        self._document_workers_count = 0
+        self._update_deferred = False
+        with self._documents_cond:
+            self._pipelines = []
+            self._document_tickets.clear()
+            self._document_turns.clear()
+            self._changed_documents.clear()
+        self._stop = threading.Event()
         self._is_closing = False
         
     def ai_worker_running(self):
@@ -478,7 +1118,7 @@ want to continue?\
             
     def is_open(self) -> bool:
         """Returnes True if the vectorstore is initiated"""
-        return self.chroma_db is not None and self._is_closing is False
+        return self.db is not None and self._is_closing is False
     
     def is_ready(self) -> bool:
         """If the vectorstore is initiated and done importing data, 
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+"""
+This file is part of QualCoder.
+
+QualCoder is free software: you can redistribute it and/or modify it under the
+terms of the GNU Lesser General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later version.
+
+QualCoder is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+See the GNU General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License along with QualCoder.
+If not, see <https://www.gnu.org/licenses/>.
+
+Author: Kai Droege (kaixxx)
+https://github.com/ccbogel/QualCoder
+https://qualcoder.wordpress.com/
+
+Storage backends for the embeddings of the AI vectorstore (see ai_vectorstore.py).
+Chroma is the default. FAISS (optional, "pip install faiss-cpu") scales better
+to very large projects, select it with 'ai_vectorstore_backend = faiss' in config.ini.
+"""
+
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _relevance_score(distance: float) -> float:
+    """Converts a (squared) L2 distance between normalized embeddings into a relevance
+    score between 0 and 1, the same way langchain does it for Chroma."""
+    return 1.0 - distance / math.sqrt(2)
+
+
+class VectorStoreBackend():
+    """Interface for the storage of the chunks of text and their embeddings.
+    The methods follow the API of the Chroma vectorstore in langchain.
+    'ids' are strings, the metadata of each chunk contains the document 'id'. """
+
+    def get(self, where=None, include=None) -> dict:
+        """Returns {'ids': [...], 'metadatas': [...]} for all chunks, or for the chunks
+        of one document if where is {'id': document id}."""
+        raise NotImplementedError
+
+    def get_embeddings(self, ids: List[str]) -> dict:
+        """Returns {'ids': [...], 'metadatas': [...], 'embeddings': [...]} for the given ids.
+        Ids which are not found are left out."""
+        raise NotImplementedError
+
+    def add(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict]):
+        """Adds chunks with precomputed embeddings"""
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def similarity_search_with_relevance_scores(self, query: str, k=4, score_threshold=None, filter=None) -> list:
+        """Returns a list of (Document, relevance score) for the chunks most similar to query.
+        filter may be {'id': {'$in': [document ids]}}."""
+        raise NotImplementedError
+
+    def persist(self):
+        """Writes all changes to disk"""
+        pass
+
+    def needs_optimize(self) -> bool:
+        """True if optimize() should be called, see AiVectorstore.optimize_db"""
+        return False
+
+    def optimize(self):
+        """Reorganizes the store for faster searches (in a background thread)"""
+        pass
+
+    def close(self):
+        """Writes all changes to disk and releases the store"""
+        self.persist()
+
+
+class ChromaBackend(VectorStoreBackend):
+    """Stores the embeddings in a chromadb collection (default)"""
+
+    def __init__(self, db_path, collection_name, embedding_function=None):
+        # These imports take several seconds, they are only loaded if the AI is used
+        from chromadb.config import Settings
+        from langchain_chroma.vectorstores import Chroma
+
+        # {"hnsw:space": "cosine"} -> defines the distance function, cosine vs. Squared L2 (default).
+        # In my limited tests, l2 gives slightly better results, although cosine is usually recommended
+        # The other settings tune the HNSW index for large imports (they only take effect
+        # when the collection is created):
+        # - "hnsw:batch_size": new vectors are collected in a brute force buffer and added
+        #   to the HNSW index in batches of this size.
+        # - "hnsw:sync_threshold": the index is persisted to disk after this many vectors
+        #   were added. A large value avoids rewriting the index again and again while
+        #   importing. 50000 covers a few hundred documents with ~100 chunks each.
+        # - "hnsw:construction_ef": size of the candidate list while building the index.
+        collection_metadata = {"hnsw:space": "l2",
+                               "hnsw:batch_size": 10000,
+                               "hnsw:sync_threshold": 50000,
+                               "hnsw:construction_ef": 128}
+        chroma_client_settings = Settings(
+                                    is_persistent=True,
+                                    persist_directory=db_path,
+                                    anonymized_telemetry=False
+                                 )
+        self.chroma_db = Chroma(client_settings=chroma_client_settings,
+                                embedding_function=embedding_function,
+                                collection_name=collection_name,
+                                collection_metadata=collection_metadata
+                         )
+
+    def get(self, where=None, include=None) -> dict:
+        return self.chroma_db.get(where=where, include=include if include is not None else ['metadatas'])
+
+    def get_embeddings(self, ids: List[str]) -> dict:
+        return self.chroma_db._collection.get(ids=ids, include=['embeddings', 'metadatas'])
+
+    def add(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict]):
+        # chromadb 0.5.0 (used on Windows) only accepts lists of floats.
+        # Note: Casting the embeddings to float16 or int8 here would not save any memory,
+        # Chroma stores all vectors (and builds the HNSW index) as float32. It would only
+        # lose precision.
+        self.chroma_db._collection.add(ids=ids, embeddings=np.asarray(embeddings).tolist(),
+                                       documents=documents, metadatas=metadatas)
+
+    def delete(self, ids: List[str]):
+        self.chroma_db.delete(ids)
+
+    def similarity_search_with_relevance_scores(self, query: str, k=4, score_threshold=None, filter=None) -> list:
+        kwargs = {'k': k}
+        if score_threshold is not None:
+            kwargs['score_threshold'] = score_threshold
+        if filter is not None:
+            kwargs['filter'] = filter
+        return self.chroma_db.similarity_search_with_relevance_scores(query, **kwargs)
+
+
+class FaissBackend(VectorStoreBackend):
+    """Stores the embeddings in a FAISS index, the texts and metadata in a sidecar
+    SQLite database keyed by the FAISS id.
+    Small collections use an exact (flat) index. Once the collection has grown to
+    train_size vectors, optimize() converts it to an IVF-PQ index, which compresses 
+    each vector to pq_m bytes. Adding vectors to it does not get slower as it grows.
+    The database is committed by persist(), the index is written at most every 
+    persist_interval seconds and by close(). After a crash, the difference is repaired 
+    when the store is opened again (see _reconcile).
+    (The index is not memory mapped: FAISS can only map IVF indexes read-only.)
+    """
+
+    nlist = 4096  # number of IVF clusters
+    pq_m = 64  # bytes per compressed vector
+    pq_nbits = 8
+    nprobe = 32  # number of clusters searched per query
+    train_size = nlist * 39  # FAISS needs at least 39 training vectors per cluster
+    persist_interval = 60  # seconds
+
+    def __init__(self, db_folder, collection_name, embedding_function=None):
+        import faiss  # optional, raises ModuleNotFoundError if not installed
+        self._faiss = faiss
+        self.embedding_function = embedding_function
+        self._lock = threading.RLock()  # used from the import pipeline, the GUI and search threads
+        os.makedirs(db_folder, exist_ok=True)
+        self.index_path = os.path.join(db_folder, collection_name + '.faiss')
+        self.conn = sqlite3.connect(os.path.join(db_folder, collection_name + '.sqlite'), check_same_thread=False)
+        cur = self.conn.cursor()
+        # AUTOINCREMENT: faiss ids of deleted chunks are never reused
+        cur.execute("CREATE TABLE IF NOT EXISTS chunks (faiss_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "uuid TEXT UNIQUE NOT NULL, doc_id INTEGER, document TEXT, metadata TEXT)")
+        cur.execute("CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)")
+        self.conn.commit()
+        self.index = None
+        if os.path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+            if hasattr(self.index, 'nprobe'):
+                self.index.nprobe = self.nprobe
+        self._index_changed = False  # changes not written to self.index_path yet
+        self._index_saved = time.monotonic()
+        self._converting = False  # see optimize
+        self._closed = False
+        self._reconcile()
+
+    def _index_ids(self) -> np.ndarray:
+        """Returns the ids of all vectors in the index"""
+        faiss = self._faiss
+        if self.index is None:
+            return np.zeros(0, dtype=np.int64)
+        if isinstance(self.index, faiss.IndexIDMap2):
+            return faiss.vector_to_array(self.index.id_map)
+        invlists = faiss.extract_index_ivf(self.index).invlists
+        ids = [faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+               for i in range(invlists.nlist) if invlists.list_size(i) > 0]
+        return np.concatenate(ids) if len(ids) > 0 else np.zeros(0, dtype=np.int64)
+
+    def _reconcile(self):
+        """The index on disk may be older than the database (after a crash, see persist).
+        Vectors without a row in the database are removed. Documents with rows but missing 
+        vectors are removed completely, AiVectorstore.update_vectorstore imports them again."""
+        cur = self.conn.cursor()
+        index_ids = self._index_ids()
+        row_ids = np.asarray([row[0] for row in cur.execute("SELECT faiss_id FROM chunks")], dtype=np.int64)
+        orphaned_ids = np.setdiff1d(index_ids, row_ids)
+        missing_ids = np.setdiff1d(row_ids, index_ids)
+        if len(orphaned_ids) == 0 and len(missing_ids) == 0:
+            return
+        logger.warning(f'FAISS index and database do not match ({len(orphaned_ids)} vectors without text, '
+                       f'{len(missing_ids)} chunks without vector), repairing the vectorstore.')
+        doc_ids = set()
+        for faiss_id in missing_ids.tolist():
+            doc_ids.add(cur.execute("SELECT doc_id FROM chunks WHERE faiss_id = ?", (faiss_id,)).fetchone()[0])
+        remove_ids = list(orphaned_ids.tolist())
+        for doc_id in doc_ids:
+            remove_ids.extend(row[0] for row in cur.execute("SELECT faiss_id FROM chunks WHERE doc_id = ?", (doc_id,)))
+            cur.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+        if self.index is not None and len(remove_ids) > 0:
+            self.index.remove_ids(np.asarray(remove_ids, dtype=np.int64))
+        self.conn.commit()
+        self._index_changed = True
+        self._write_index()
+
+    def _faiss_ids(self, ids: List[str]) -> list:
+        cur = self.conn.cursor()
+        faiss_ids = []
+        for uuid_ in ids:
+            row = cur.execute("SELECT faiss_id FROM chunks WHERE uuid = ?", (uuid_,)).fetchone()
+            if row is not None:
+                faiss_ids.append(row[0])
+        return faiss_ids
+
+    def get(self, where=None, include=None) -> dict:
+        with self._lock:
+            cur = self.conn.cursor()
+            if where is None:
+                cur.execute("SELECT uuid, metadata, document FROM chunks ORDER BY faiss_id")
+            elif list(where.keys()) == ['id']:
+                cur.execute("SELECT uuid, metadata, document FROM chunks WHERE doc_id = ? ORDER BY faiss_id",
+                            (where['id'],))
+            else:
+                raise ValueError(f'FaissBackend.get: unsupported filter {where}')
+            rows = cur.fetchall()
+        res = {'ids': [row[0] for row in rows], 'metadatas': [json.loads(row[1]) for row in rows]}
+        if include is not None and 'documents' in include:
+            res['documents'] = [row[2] for row in rows]
+        return res
+
+    def get_embeddings(self, ids: List[str]) -> dict:
+        res = {'ids': [], 'metadatas': [], 'embeddings': []}
+        with self._lock:
+            if self.index is None:
+                return res
+            cur = self.conn.cursor()
+            for uuid_ in ids:
+                row = cur.execute("SELECT faiss_id, metadata FROM chunks WHERE uuid = ?", (uuid_,)).fetchone()
+                if row is None:
+                    continue
+                try:
+                    embedding = self.index.reconstruct(row[0])
+                except RuntimeError:  # index type without reconstruct
+                    continue
+                res['ids'].append(uuid_)
+                res['metadatas'].append(json.loads(row[1]))
+                res['embeddings'].append(embedding)
+        return res
+
+    def add(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict]):
+        vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock:
+            cur = self.conn.cursor()
+            faiss_ids = []
+            for uuid_, document, metadata in zip(ids, documents, metadatas):
+                cur.execute("INSERT INTO chunks (uuid, doc_id, document, metadata) VALUES (?, ?, ?, ?)",
+                            (uuid_, metadata.get('id'), document, json.dumps(metadata)))
+                faiss_ids.append(cur.lastrowid)
+            if self.index is None:
+                self.index = self._faiss.IndexIDMap2(self._faiss.IndexFlatL2(vectors.shape[1]))
+            self.index.add_with_ids(vectors, np.asarray(faiss_ids, dtype=np.int64))
+            self._index_changed = True
+
+    def needs_optimize(self) -> bool:
+        with self._lock:
+            return not self._converting and not self._closed and self.index is not None \
+                and isinstance(self.index, self._faiss.IndexIDMap2) \
+                and self.index.ntotal >= self.train_size and self.index.d % self.pq_m == 0
+
+    def optimize(self):
+        """Replaces the flat index with a compressed IVF-PQ index, trained on a sample of the vectors.
+        The training takes several minutes. It runs without holding the lock, so the store 
+        can still be searched and changed. These changes are carried over at the end."""
+        faiss = self._faiss
+        with self._lock:
+            if not self.needs_optimize():
+                return
+            self._converting = True
+            flat_index = self.index
+            logger.debug(f'Converting the FAISS index with {flat_index.ntotal} vectors to IVF-PQ.')
+            vectors = flat_index.index.reconstruct_n(0, flat_index.ntotal)
+            faiss_ids = faiss.vector_to_array(flat_index.id_map)
+        try:
+            sample_size = min(len(vectors), self.nlist * 64)
+            sample = vectors[np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)]
+            quantizer = faiss.IndexFlatL2(flat_index.d)
+            ivf = faiss.IndexIVFPQ(quantizer, flat_index.d, self.nlist, self.pq_m, self.pq_nbits)
+            ivf.train(sample)
+            ivf.set_direct_map_type(faiss.DirectMap.Hashtable)  # needed for reconstruct and remove_ids
+            ivf.add_with_ids(vectors, faiss_ids)
+            ivf.nprobe = self.nprobe
+            del vectors, sample
+            with self._lock:
+                if self._closed or self.index is not flat_index:
+                    return
+                # Carry over the changes made during the training (faiss ids are never reused)
+                current_ids = faiss.vector_to_array(flat_index.id_map)
+                removed_ids = np.setdiff1d(faiss_ids, current_ids)
+                if len(removed_ids) > 0:
+                    ivf.remove_ids(removed_ids)
+                added_ids = np.setdiff1d(current_ids, faiss_ids)
+                if len(added_ids) > 0:
+                    ivf.add_with_ids(np.vstack([flat_index.reconstruct(int(faiss_id)) for faiss_id in added_ids]),
+                                     added_ids)
+                self.index = ivf
+                self._index_changed = True
+                self._write_index()
+        finally:
+            with self._lock:
+                self._converting = False
+
+    def delete(self, ids: List[str]):
+        with self._lock:
+            faiss_ids = self._faiss_ids(ids)
+            if len(faiss_ids) == 0:
+                return
+            if self.index is not None:
+                self.index.remove_ids(np.asarray(faiss_ids, dtype=np.int64))
+                self._index_changed = True
+            self.conn.executemany("DELETE FROM chunks WHERE faiss_id = ?", [(faiss_id,) for faiss_id in faiss_ids])
+
+    def similarity_search_with_relevance_scores(self, query: str, k=4, score_threshold=None, filter=None) -> list:
+        from langchain_core.documents.base import Document
+        query_vector = np.asarray([self.embedding_function.embed_query(query)], dtype=np.float32)
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return []
+            cur = self.conn.cursor()
+            params = None
+            if filter is not None:
+                doc_ids = filter['id']['$in']
+                placeholders = ','.join('?' * len(doc_ids))
+                cur.execute(f"SELECT faiss_id FROM chunks WHERE doc_id IN ({placeholders})", doc_ids)
+                selector = self._faiss.IDSelectorBatch(np.asarray([row[0] for row in cur.fetchall()],
+                                                                  dtype=np.int64))
+                if hasattr(self.index, 'nprobe'):
+                    params = self._faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+                else:
+                    params = self._faiss.SearchParameters(sel=selector)
+            distances, faiss_ids = self.index.search(query_vector, k, params=params)
+            res = []
+            for distance, faiss_id in zip(distances[0], faiss_ids[0]):
+                if faiss_id < 0:  # fewer than k results
+                    continue
+                score = _relevance_score(float(distance))
+                if score_threshold is not None and score < score_threshold:
+                    continue
+                row = cur.execute("SELECT document, metadata FROM chunks WHERE faiss_id = ?",
+                                  (int(faiss_id),)).fetchone()
+                if row is not None:
+                    res.append((Document(page_content=row[0], metadata=json.loads(row[1])), score))
+        return res
+
+    def _write_index(self):
+        """Writes the index to a temporary file first, so a crash cannot leave a broken index."""
+        with self._lock:
+            if self.index is not None and self._index_changed:
+                tmp_path = self.index_path + '.tmp'
+                self._faiss.write_index(self.index, tmp_path)
+                os.replace(tmp_path, self.index_path)
+            self._index_changed = False
+            self._index_saved = time.monotonic()
+
+    def persist(self, force=False):
+        """Commits the database. Writing a large index takes a while, it is only written 
+        if persist_interval seconds have passed since the last time (or if force is True)."""
+        with self._lock:
+            if self._closed:
+                return
+            self.conn.commit()
+            if force or time.monotonic() - self._index_saved >= self.persist_interval:
+                self._write_index()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self.persist(force=True)
+            self._closed = True
+            self.conn.close()
@@ -0,0 +1,173 @@
+import importlib.util
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import TestCase
+import uuid
+
+import numpy as np
+
+from qualcoder.ai_vectorstore_backends import FaissBackend
+
+""" Tests of the optional FAISS backend of the AI vectorstore.
+Skipped if faiss (pip install faiss-cpu) is not installed.
+"""
+
+
+class QueryEmbedding:
+    """Stands in for the embedding function, embed_query returns a preset vector"""
+
+    def __init__(self):
+        self.vector = None
+
+    def embed_query(self, text):
+        return self.vector
+
+
+class SmallFaissBackend(FaissBackend):
+    """Small IVF-PQ settings, so the conversion runs with a few hundred vectors"""
+    nlist = 8
+    pq_m = 8
+    pq_nbits = 3
+    nprobe = 8
+    train_size = nlist * 39
+
+
+@unittest.skipIf(importlib.util.find_spec('faiss') is None, 'faiss is not installed')
+class TestFaissBackend(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.embedding = QueryEmbedding()
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((400, 64)).astype(np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.ids = [str(uuid.uuid4()) for _ in range(len(self.vectors))]
+        self.backend = self.open_backend()
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def open_backend(self):
+        return SmallFaissBackend(self.folder, 'test', self.embedding)
+
+    def add_chunks(self, backend, start, end, docs_count=5):
+        """Adds the vectors start to end, the chunk i belongs to the document i % docs_count"""
+        backend.add(self.ids[start:end], self.vectors[start:end],
+                    [f'text {i}' for i in range(start, end)],
+                    [{'id': i % docs_count, 'name': f'doc {i % docs_count}', 'start_index': i,
+                      'content_hash': str(i)} for i in range(start, end)])
+
+    def search(self, backend, i, **kwargs):
+        self.embedding.vector = self.vectors[i]
+        return backend.similarity_search_with_relevance_scores('query', **kwargs)
+
+    def test_add_get_delete(self):
+        self.add_chunks(self.backend, 0, 100)
+        self.assertEqual(len(self.backend.get()['ids']), 100)
+        chunks = self.backend.get(where={'id': 2}, include=['documents'])
+        self.assertEqual(len(chunks['ids']), 20)
+        self.assertTrue(all(metadata['id'] == 2 for metadata in chunks['metadatas']))
+        self.assertEqual(chunks['documents'][0], 'text 2')
+        embeddings = self.backend.get_embeddings(self.ids[5:7] + ['unknown'])
+        self.assertEqual(embeddings['ids'], self.ids[5:7])
+        self.assertTrue(np.allclose(embeddings['embeddings'][0], self.vectors[5]))
+        self.backend.delete(chunks['ids'])
+        self.assertEqual(len(self.backend.get()['ids']), 80)
+        self.assertEqual(self.backend.index.ntotal, 80)
+        self.assertEqual(self.backend.get(where={'id': 2})['ids'], [])
+
+    def test_search(self):
+        self.add_chunks(self.backend, 0, 100)
+        document, score = self.search(self.backend, 7, k=3)[0]
+        self.assertEqual(document.page_content, 'text 7')
+        self.assertAlmostEqual(score, 1.0, places=5)
+        results = self.search(self.backend, 7, k=5, filter={'id': {'$in': [3, 4]}})
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(document.metadata['id'] in (3, 4) for document, _ in results))
+        self.assertEqual(len(self.search(self.backend, 7, k=10, score_threshold=0.99)), 1)
+
+    def test_close_and_reopen(self):
+        self.add_chunks(self.backend, 0, 100)
+        self.backend.close()
+        self.backend = self.open_backend()
+        self.assertEqual(self.backend.index.ntotal, 100)
+        self.assertEqual(len(self.backend.get()['ids']), 100)
+
+    def test_reconcile_after_crash(self):
+        self.add_chunks(self.backend, 0, 100)
+        self.backend.close()
+        # Changes committed to the database, but the index is not written (as after a crash):
+        self.backend = self.open_backend()
+        self.backend.delete(self.backend.get(where={'id': 1})['ids'])
+        self.backend.add(self.ids[100:105], self.vectors[100:105], ['new text'] * 5,
+                         [{'id': 3, 'name': 'doc 3', 'start_index': 0, 'content_hash': 'new'}] * 5)
+        self.backend.persist()
+        self.backend.conn.close()
+        self.backend = self.open_backend()
+        # document 1 stays deleted, document 3 (chunks missing in the index) is removed
+        self.assertEqual(len(self.backend.get()['ids']), 60)
+        self.assertEqual(self.backend.index.ntotal, 60)
+        self.assertEqual({metadata['id'] for metadata in self.backend.get()['metadatas']}, {0, 2, 4})
+
+    def test_optimize(self):
+        self.add_chunks(self.backend, 0, 300)
+        self.assertFalse(self.backend.needs_optimize())
+        self.add_chunks(self.backend, 300, 350)
+        self.assertTrue(self.backend.needs_optimize())
+        self.backend.optimize()
+        self.assertFalse(self.backend.needs_optimize())
+        self.assertEqual(type(self.backend.index).__name__, 'IndexIVFPQ')
+        self.assertEqual(self.backend.index.ntotal, 350)
+        # compressed vectors: the nearest chunk is still found
+        self.assertEqual(self.search(self.backend, 7, k=3)[0][0].page_content, 'text 7')
+        results = self.search(self.backend, 7, k=5, filter={'id': {'$in': [3]}})
+        self.assertTrue(len(results) > 0)
+        self.assertTrue(all(document.metadata['id'] == 3 for document, _ in results))
+        self.backend.delete(self.ids[:10])
+        self.add_chunks(self.backend, 350, 400)
+        self.assertEqual(self.backend.index.ntotal, 390)
+        self.backend.close()
+        self.backend = self.open_backend()
+        self.assertEqual(type(self.backend.index).__name__, 'IndexIVFPQ')
+        self.assertEqual(self.backend.index.ntotal, 390)
+        self.assertEqual(len(self.backend.get()['ids']), 390)
+
+    def test_changes_during_optimize(self):
+        """The store can be changed while the IVF-PQ index is trained"""
+        import faiss
+        training = threading.Event()
+        go_on = threading.Event()
+
+        class SlowIndexIVFPQ(faiss.IndexIVFPQ):
+            def train(self, x):
+                training.set()
+                go_on.wait(10)
+                super().train(x)
+
+        class FaissWithSlowTraining:
+            IndexIVFPQ = SlowIndexIVFPQ
+
+            def __getattr__(self, name):
+                return getattr(faiss, name)
+
+        self.backend._faiss = FaissWithSlowTraining()
+        self.add_chunks(self.backend, 0, 350)
+        thread = threading.Thread(target=self.backend.optimize)
+        thread.start()
+        self.assertTrue(training.wait(10))
+        self.backend.delete(self.ids[:10])
+        self.add_chunks(self.backend, 350, 400)
+        self.assertEqual(self.search(self.backend, 380, k=1)[0][0].page_content, 'text 380')
+        go_on.set()
+        thread.join(30)
+        self.assertEqual(type(self.backend.index).__name__, 'SlowIndexIVFPQ')
+        self.assertEqual(self.backend.index.ntotal, 390)
+        self.assertEqual(self.backend.get_embeddings(self.ids[:10])['ids'], [])
+        self.assertEqual(len(self.backend.get_embeddings(self.ids[350:360])['ids']), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()